@@ -1,22 +1,30 @@
-# import chromadb
+# import sqlite3
+# import sys
+# import faiss
+# import numpy as np
 
-# # Connect to your local vector store
-# client = chromadb.PersistentClient(path="./vectorstore/chroma")
+# sys.path.insert(0, "./scripts")
+# from build_vectorstore import EMBED_MODEL, load_embeddings, load_pooling_mode
 
-# # Get the collection
-# collection = client.get_or_create_collection("module_341_urinary_catheterization")
+# # Connect to your local vector store (memory-mapped, skips a full load)
+# name  = "module_341_urinary_catheterization"
+# index = faiss.read_index(f"./vectorstore/faiss/{name}.faiss", faiss.IO_FLAG_MMAP)
+# db    = sqlite3.connect(f"./vectorstore/faiss/{name}.db")
 
 # # Check how many items
-# print(f"Total items: {collection.count()}")
+# print(f"Total items: {index.ntotal}")
 
 # # Peek at some data
-# results = collection.peek(limit=5)
+# results = db.execute("SELECT id, doc_type, text FROM documents ORDER BY row LIMIT 5").fetchall()
 # print(results)
 
-# # Query example
-# query_results = collection.query(
-#     query_texts=["urinary catheterization procedure"],
-#     n_results=3
-# )
-# print(query_results)
-
+# # Query example (embed the query with the same model used to build the index)
+# embeddings = load_embeddings(load_pooling_mode(EMBED_MODEL))
+# query_vec  = embeddings.embed_query("urinary catheterization procedure")
+# distances, rows = index.search(np.array([query_vec], dtype="float32"), 3)
+# query_results = [
+#     (float(dist), *db.execute("SELECT id, metadata_json, text FROM documents WHERE row = ?", (int(row),)).fetchone())
+#     for dist, row in zip(distances[0], rows[0])
+#     if row != -1  # HNSW pads with -1 when it finds fewer than k neighbours
+# ]
+# print(query_results)  # nearest first: (distance, id, metadata_json, text)
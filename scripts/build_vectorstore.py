@@ -1,34 +1,237 @@
-import json
 import logging
+import os
 import re
+import sqlite3
+import faiss
+import numpy as np
+import orjson
+import torch
+from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from huggingface_hub import hf_hub_download
 from langchain_core.documents import Document
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from onnxruntime import GraphOptimizationLevel, InferenceSession, SessionOptions
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoModel, AutoTokenizer
+from transformers import logging as hf_logging
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 logger = logging.getLogger(__name__)
 
 BASE_DIR        = Path(__file__).parent.parent
 PREPROCESSED_DIR = BASE_DIR / "data" / "preprocessed" / "static_preprocessed_data"
-CHROMA_DIR      = str(BASE_DIR / "vectorstore" / "chroma")
+VECTORSTORE_DIR = BASE_DIR / "vectorstore" / "faiss"
+ONNX_DIR        = BASE_DIR / "models" / "medembed_onnx"
+QUANT_DIR       = BASE_DIR / "models" / "medembed_onnx_int8"
 
-EMBED_MODEL = "abhinand/MedEmbed-small-v0.1"
+DEVICE = "cuda" if torch.cuda.is_available() else ("mps" if torch.backends.mps.is_available() else "cpu")
 
-# ── Load embedding model once (shared across all modules) ─────────────────────
-logger.info(f"Loading embedding model: {EMBED_MODEL}")
-embeddings = HuggingFaceEmbeddings(
-    model_name=EMBED_MODEL,
-    model_kwargs={"device": "cpu"},
-    encode_kwargs={"normalize_embeddings": True}
+EMBED_MODEL   = "abhinand/MedEmbed-small-v0.1"
+# "onnx" = INT8 ONNX Runtime (CPU), "torch" = PyTorch (fp16 CUDA / fp32 MPS / bf16-or-fp32 CPU)
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "onnx" if DEVICE == "cpu" else "torch").strip().lower()
+if EMBED_BACKEND not in ("onnx", "torch"):
+    raise ValueError(f"EMBED_BACKEND must be 'onnx' or 'torch', got {EMBED_BACKEND!r}")
+EMBED_BATCH   = 64 if DEVICE == "cpu" else 128
+MAX_TOKENS    = 512
+
+# CPU embedding is sharded over worker processes; GPU embedding runs in-process
+THREADS_PER_WORKER = 2
+NUM_WORKERS        = max(1, (os.cpu_count() or 1) // THREADS_PER_WORKER)
+
+HNSW_M               = 32
+HNSW_EF_CONSTRUCTION = 200
+
+# ── Metadata sidecar: one SQLite row per vector, `row` = position in the index ─
+CREATE_DOCUMENTS = """
+CREATE TABLE IF NOT EXISTS documents (
+    id            TEXT    PRIMARY KEY,
+    row           INTEGER NOT NULL UNIQUE,
+    doc_type      TEXT,
+    metadata_json TEXT    NOT NULL,
+    text          TEXT    NOT NULL
 )
-logger.info("Embedding model loaded")
+"""
+
+
+# ── Pooling + shared encode loop ──────────────────────────────────────────────
+def load_pooling_mode(model_name):
+    """Read the sentence-transformers pooling config so we pool exactly like HuggingFaceEmbeddings."""
+    pooling = orjson.loads(Path(hf_hub_download(model_name, "1_Pooling/config.json")).read_bytes())
+    return "cls" if pooling.get("pooling_mode_cls_token") else "mean"
+
+
+def pool_and_normalize(hidden, attention_mask, pooling, out):
+    """Pool (B, S, D) fp32 hidden states straight into `out` (B, D) and L2-normalize it in place.
+    Masked mean-pooling is one einsum, so no (B, S, D) masked copy is materialized."""
+    if pooling == "cls":
+        out[:] = hidden[:, 0]
+    else:
+        mask = attention_mask.astype(np.float32)
+        np.einsum("bsd,bs->bd", hidden, mask, out=out)
+        out /= np.maximum(mask.sum(axis=1, keepdims=True), 1e-9)
+    out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+
+
+class PooledEmbeddings(Embeddings):
+    """Batching loop shared by the backends: texts are tokenized once up front with the fast (Rust)
+    tokenizer, batched in length order, each batch padded only to its own longest sequence, and
+    pooled in NumPy."""
+
+    def __init__(self, model_name_or_dir, pooling: str = "mean", batch_size: int = 64):
+        self.tokenizer  = AutoTokenizer.from_pretrained(model_name_or_dir, use_fast=True)
+        self.pooling    = pooling
+        self.batch_size = batch_size
+
+    def _pad(self, features):
+        # pad() after a single up-front tokenize is intentional here; mute only the
+        # "use __call__ instead" advice it logs for fast tokenizers
+        verbosity = hf_logging.get_verbosity()
+        hf_logging.set_verbosity_error()
+        try:
+            return self.tokenizer.pad(features, return_tensors="np")
+        finally:
+            hf_logging.set_verbosity(verbosity)
+
+    @abstractmethod
+    def _forward(self, batch):
+        """Return the fp32 last_hidden_state ndarray for one padded batch (dict of NumPy arrays)."""
+
+    def encode(self, texts):
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        enc = self.tokenizer(list(texts), padding=False, truncation=True, max_length=MAX_TOKENS)
+
+        # Length-bucket: batch texts in token-length order so short MCQs aren't padded out to
+        # long competencies/checklists, then scatter rows back to input order at the end
+        order = np.argsort([len(ids) for ids in enc["input_ids"]], kind="stable")
+        enc   = {k: [v[i] for i in order] for k, v in enc.items()}
+
+        pooled = None
+        for start in range(0, len(texts), self.batch_size):
+            batch = self._pad({k: v[start:start + self.batch_size] for k, v in enc.items()})
+            hidden = self._forward(batch)
+            if pooled is None:
+                pooled = np.empty((len(texts), hidden.shape[-1]), dtype=np.float32)
+            pool_and_normalize(hidden, batch["attention_mask"], self.pooling, pooled[start:start + len(hidden)])
+
+        out = np.empty_like(pooled)
+        out[order] = pooled
+        return out
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# ── INT8 ONNX embedding model ─────────────────────────────────────────────────
+def export_quantized_model():
+    """Export EMBED_MODEL to ONNX and INT8-quantize it once; later runs reuse the saved copy."""
+    if (QUANT_DIR / "model_quantized.onnx").exists():
+        return QUANT_DIR
+
+    logger.info(f"Exporting {EMBED_MODEL} to ONNX + INT8 (one-time)")
+    ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL, export=True).save_pretrained(ONNX_DIR)
+    AutoTokenizer.from_pretrained(EMBED_MODEL).save_pretrained(QUANT_DIR)
+
+    quantizer = ORTQuantizer.from_pretrained(ONNX_DIR)
+    quantizer.quantize(
+        save_dir=QUANT_DIR,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True),
+    )
+    return QUANT_DIR
+
+
+class ONNXEmbeddings(PooledEmbeddings):
+    """Drop-in for HuggingFaceEmbeddings backed by the INT8 ONNX model (pooled + L2-normalized)."""
+
+    def __init__(self, model_dir: Path, pooling: str = "mean", batch_size: int = 64, num_threads: int = None):
+        super().__init__(model_dir, pooling, batch_size)
+
+        options = SessionOptions()
+        options.intra_op_num_threads     = num_threads or os.cpu_count()
+        options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session     = InferenceSession(
+            str(model_dir / "model_quantized.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _forward(self, batch):
+        feeds = {k: v.astype(np.int64) for k, v in batch.items() if k in self.input_names}
+        return self.session.run(["last_hidden_state"], feeds)[0]
+
+
+# ── PyTorch embedding model (GPU, or bf16 CPU) ────────────────────────────────
+def cpu_supports_bf16():
+    return torch.backends.mkldnn.enabled and torch.cpu._is_avx512_bf16_supported()
+
+
+def torch_dtype_for(device):
+    if device == "cuda":
+        return torch.float16
+    if device == "cpu" and cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+class TorchEmbeddings(PooledEmbeddings):
+    """EMBED_MODEL on PyTorch: fp16 on CUDA, bf16 on CPUs with native bf16 GEMM, fp32 otherwise."""
+
+    def __init__(self, model_name: str, pooling: str = "mean", batch_size: int = 64,
+                 num_threads: int = None, device: str = "cpu"):
+        super().__init__(model_name, pooling, batch_size)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = device
+        self.dtype  = torch_dtype_for(device)
+        self.model  = AutoModel.from_pretrained(model_name, dtype=self.dtype).to(device).eval()
+
+    @torch.inference_mode()
+    def _forward(self, batch):
+        inputs = {k: torch.from_numpy(v).to(self.device) for k, v in batch.items()}
+        # Upcast only the final hidden state so pooling/normalizing accumulate in fp32
+        return self.model(**inputs).last_hidden_state.float().cpu().numpy()
+
+
+def load_embeddings(pooling, num_threads=None):
+    if EMBED_BACKEND == "onnx":
+        return ONNXEmbeddings(
+            export_quantized_model(), pooling=pooling, batch_size=EMBED_BATCH, num_threads=num_threads
+        )
+    return TorchEmbeddings(
+        EMBED_MODEL, pooling=pooling, batch_size=EMBED_BATCH, num_threads=num_threads, device=DEVICE
+    )
+
+
+# ── Parallel embedding: one model per worker process, sharded over cores ──────
+_worker_embeddings = None
+
+
+def _init_worker(pooling):
+    global _worker_embeddings
+    _worker_embeddings = load_embeddings(pooling, num_threads=THREADS_PER_WORKER)
+
+
+def _embed_shard(texts):
+    return _worker_embeddings.encode(texts)
+
+
+def embed_parallel(pool, texts):
+    """Split texts into NUM_WORKERS contiguous shards, embed them concurrently, keep input order."""
+    shard_size = -(-len(texts) // NUM_WORKERS)
+    shards     = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+    return np.concatenate(list(pool.map(_embed_shard, shards)))
 
 
 # ── Load documents from one preprocessed JSON ─────────────────────────────────
 def load_module_documents(json_path: Path):
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = orjson.loads(json_path.read_bytes())
 
     module_info     = data['module_info']
     collection_name = (
@@ -54,6 +257,73 @@ def load_module_documents(json_path: Path):
     return documents, ids, collection_name
 
 
+# ── Write one collection: FAISS HNSW index + SQLite metadata ─────────────────
+def load_existing_ids(collection_name):
+    """IDs already stored in the collection. If the index and sidecar disagree — one file missing,
+    or vector count != row count after an interrupted write — both are removed so the collection
+    is rebuilt from scratch instead of appending on top of orphaned vectors or rows."""
+    index_path = VECTORSTORE_DIR / f"{collection_name}.faiss"
+    db_path    = VECTORSTORE_DIR / f"{collection_name}.db"
+    if not index_path.exists() and not db_path.exists():
+        return set()
+
+    ids, ntotal = None, None
+    if index_path.exists() and db_path.exists():
+        ntotal = faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP).ntotal
+        conn   = sqlite3.connect(db_path)
+        try:
+            conn.execute(CREATE_DOCUMENTS)
+            ids = {doc_id for (doc_id,) in conn.execute("SELECT id FROM documents")}
+        finally:
+            conn.close()
+
+    if ids is None or len(ids) != ntotal:
+        reason = (
+            f"{'index' if not index_path.exists() else 'sidecar'} file missing" if ids is None
+            else f"index has {ntotal} vectors, sidecar has {len(ids)} rows"
+        )
+        logger.warning(f"  Collection is inconsistent ({reason}) — rebuilding")
+        index_path.unlink(missing_ok=True)
+        db_path.unlink(missing_ok=True)
+        return set()
+    return ids
+
+
+def write_collection(collection_name, ids, texts, metas, embs):
+    """Append vectors to the collection's int8 HNSW index (creating it on first run) and
+    their metadata to the sidecar; returns the collection's total vector count."""
+    index_path = VECTORSTORE_DIR / f"{collection_name}.faiss"
+    if index_path.exists():
+        index = faiss.read_index(str(index_path))
+    else:
+        dim   = embs.shape[1]
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        # Vectors are L2-normalized, so every component lies in [-1, 1]. Train the quantizer on
+        # those fixed bounds rather than the first batch, whose range later appends may exceed
+        index.train(np.vstack([-np.ones((1, dim)), np.ones((1, dim))]).astype(np.float32))
+
+    first_row = index.ntotal
+    index.add(embs)
+    faiss.write_index(index, str(index_path))
+
+    conn = sqlite3.connect(VECTORSTORE_DIR / f"{collection_name}.db")
+    try:
+        conn.execute(CREATE_DOCUMENTS)
+        conn.executemany(
+            "INSERT INTO documents (id, row, doc_type, metadata_json, text) VALUES (?, ?, ?, ?, ?)",
+            [
+                (doc_id, row, meta.get('doc_type'), orjson.dumps(meta).decode(), text)
+                for row, (doc_id, text, meta) in enumerate(zip(ids, texts, metas), start=first_row)
+            ],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    return index.ntotal
+
+
 # ── Main: loop over all preprocessed JSONs ────────────────────────────────────
 def main():
     pre_files = sorted(PREPROCESSED_DIR.glob("processed_module_*.json"))
@@ -62,8 +332,27 @@ def main():
         return
 
     logger.info(f"Found {len(pre_files)} preprocessed file(s) to vectorize\n")
+    VECTORSTORE_DIR.mkdir(parents=True, exist_ok=True)
     grand_total = 0
 
+    # Resolve pooling + export the ONNX model up front so workers don't race on it
+    pooling = load_pooling_mode(EMBED_MODEL)
+    if EMBED_BACKEND == "onnx":
+        export_quantized_model()
+
+    # No subprocess on GPU: a forked child can't safely initialize CUDA, and one model owns the device
+    if DEVICE == "cpu":
+        logger.info(
+            f"Starting {NUM_WORKERS} embedding worker(s) x {THREADS_PER_WORKER} threads "
+            f"({EMBED_MODEL}, backend: {EMBED_BACKEND})"
+        )
+        pool  = ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=_init_worker, initargs=(pooling,))
+        embed = partial(embed_parallel, pool)
+    else:
+        logger.info(f"Loading embedding model in-process ({EMBED_MODEL}, backend: {EMBED_BACKEND}, device: {DEVICE})")
+        pool  = None
+        embed = load_embeddings(pooling).encode
+
     for pre_path in pre_files:
         logger.info(f"Processing: {pre_path.name}")
         try:
@@ -72,28 +361,36 @@ def main():
             logger.info(f"  Collection : {collection_name}")
             logger.info(f"  Documents  : {len(documents)}")
 
-            vectorstore = Chroma(
-                collection_name=collection_name,
-                embedding_function=embeddings,
-                persist_directory=CHROMA_DIR
-            )
-
-            existing_count = vectorstore._collection.count()
-            if existing_count > 0:
-                logger.warning(f"  Collection already exists with {existing_count} vectors — upserting")
+            # Only embed documents whose IDs aren't stored yet
+            existing = load_existing_ids(collection_name)
+            new_idx  = [i for i, doc_id in enumerate(ids) if doc_id not in existing]
+            if existing:
+                logger.warning(
+                    f"  Collection already has {len(existing)} vectors — adding {len(new_idx)} new"
+                )
+            if not new_idx:
+                logger.info("  Nothing to do")
+                grand_total += len(existing)
+                continue
 
-            vectorstore.add_documents(documents=documents, ids=ids)
+            new_ids = [ids[i] for i in new_idx]
+            texts   = [documents[i].page_content for i in new_idx]
+            metas   = [documents[i].metadata for i in new_idx]
+            embs    = embed(texts)
 
-            final_count = vectorstore._collection.count()
+            final_count = write_collection(collection_name, new_ids, texts, metas, embs)
             grand_total += final_count
             logger.info(f" Final vector count: {final_count}")
 
         except Exception as e:
             logger.error(f" Failed on {pre_path.name}: {e}", exc_info=True)
 
+    if pool is not None:
+        pool.shutdown()
+
     logger.info(f"\n{'='*60}")
     logger.info(f"All done! Total vectors across all collections: {grand_total}")
-    logger.info(f"Saved to: {CHROMA_DIR}")
+    logger.info(f"Saved to: {VECTORSTORE_DIR}")
     logger.info(f"{'='*60}")
 
 
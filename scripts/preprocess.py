@@ -1,6 +1,9 @@
-import json
+import argparse
 import re
 import logging
+import blake3
+import ijson
+import orjson
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
@@ -12,18 +15,27 @@ OUTPUT_DIR = BASE_DIR / "data" / "preprocessed" / "static_preprocessed_data"
 
 MAX_CHARS = 2048  # 512 tokens * 4 chars/token
 
+_HTML_TAG   = re.compile(r'<[^>]+>')
+_QUOTED_SEP = re.compile(r"',\s*'")
+_WHITESPACE = re.compile(r'\s+')
+
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
 def clean_html(text):
-    return re.sub(r'<[^>]+>', '', text)
+    return _HTML_TAG.sub('', text)
+
+def collapse_whitespace(text):
+    # Tag stripping leaves the source's indentation/newline runs behind — only worth
+    # dropping from embedding_text; stored metadata keeps the original layout
+    return _WHITESPACE.sub(' ', text).strip()
 
 def parse_quoted_list(text):
     if not text:
         return []
     # Strip outer whitespace, then split on ', ' between quoted items
     text = text.strip()
-    items = re.split(r"',\s*'", text)
+    items = _QUOTED_SEP.split(text)
     # Strip leading/trailing quote from first and last item
     if items:
         items[0] = items[0].lstrip("'")
@@ -36,6 +48,15 @@ def truncate_if_needed(text, max_chars=MAX_CHARS):
     logger.warning(f"Text truncated: {len(text)} → {max_chars} chars")
     return text[:max_chars]
 
+def iter_modules(json_path):
+    """Yield the raw modules of a JSON file one at a time in a single streaming pass.
+    The top level is either a list of modules or one module object."""
+    with open(json_path, 'rb') as f:
+        _, root_event, _ = next(ijson.parse(f))
+        f.seek(0)
+        prefix = 'item' if root_event == 'start_array' else ''
+        yield from ijson.items(f, prefix, use_float=True)
+
 def safe_get(lst, index, fallback=""):
     """Only used for parallel lists that may genuinely be mismatched."""
     try:
@@ -45,12 +66,41 @@ def safe_get(lst, index, fallback=""):
         return fallback
 
 
+def file_hash(path):
+    """BLAKE3 hex digest of a file, read in 1 MiB chunks."""
+    hasher = blake3.blake3()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def cached_summary(out_path):
+    """(source_hash, total_vectors) recorded in an existing processed file ((None, 0) if missing/unreadable)."""
+    if not out_path.exists():
+        return None, 0
+    src_hash, total = None, None
+    try:
+        with open(out_path, 'rb') as f:
+            # Both keys precede the record lists, so this stops after the header
+            for prefix, event, value in ijson.parse(f):
+                if prefix == 'module_info.source_hash':
+                    src_hash = value
+                elif prefix == 'total_vectors':
+                    total = int(value)
+                if src_hash is not None and total is not None:
+                    break
+    except ijson.JSONError:
+        return None, 0
+    return src_hash, total or 0
+
+
 # ── Per-module processor ───────────────────────────────────────────────────────
 
 def process_module(module):
     module_fields = module['key_module_field']
     course_id     = module_fields['course_id']
     module_name   = module_fields['competency_name']
+    module_domain = module_fields['module_domain']
     logger.info(f"  Module: {module_name} (Course ID: {course_id})")
 
     competencies, mcqs, checklists = [], [], []
@@ -59,6 +109,9 @@ def process_module(module):
     for comp_group in module['question_type_mcq']:
         comp      = comp_group['competency']
         questions = comp_group['question']
+        comp_id   = comp['competency_id']
+        comp_type = comp['competency_type']
+        comp_area = comp['module_compentency_area']
 
         question_ids        = parse_quoted_list(questions['question_ids'])
         question_texts      = parse_quoted_list(questions['question_texts'])
@@ -76,39 +129,41 @@ def process_module(module):
         ]:
             if len(lst) != expected:
                 logger.warning(
-                    f"  [{comp['competency_id']}] '{name}' length {len(lst)} "
+                    f"  [{comp_id}] '{name}' length {len(lst)} "
                     f"!= question_ids length {expected}. Will use fallback for missing entries."
                 )
 
         # ── Competency record ─────────────────────────────────────────────────
         if not question_ids:
-            logger.info(f"  [{comp['competency_id']}] No question IDs found — competency saved, no MCQs generated.")
+            logger.info(f"  [{comp_id}] No question IDs found — competency saved, no MCQs generated.")
 
-        objectives_text = "\n".join(f"- {obj}" for obj in learning_objectives[:10])
+        objectives_text  = "\n".join([f"- {obj}" for obj in learning_objectives[:10]])
+        definition_clean = clean_html(comp['module_competency_definition'])
+        activities_clean = comp['activity_names'].replace("'", "")
 
         embed_text = truncate_if_needed(
-            f"Competency: {comp['module_compentency_area']}\n"
-            f"Type: {comp['competency_type']}\n\n"
-            f"Definition: {clean_html(comp['module_competency_definition'])}\n\n"
+            f"Competency: {comp_area}\n"
+            f"Type: {comp_type}\n\n"
+            f"Definition: {collapse_whitespace(definition_clean)}\n\n"
             f"This competency assesses:\n{objectives_text}\n\n"
-            f"Activities: {comp['activity_names'].replace(chr(39), '')}"
+            f"Activities: {activities_clean}"
         )
 
         competencies.append({
-            'id': comp['competency_id'],
+            'id': comp_id,
             'embedding_text': embed_text,
             'metadata': {
                 'doc_type':                     'competency',
-                'competency_id':                comp['competency_id'],
-                'competency_type':              comp['competency_type'],
-                'module_compentency_area':      comp['module_compentency_area'],
-                'module_competency_definition': clean_html(comp['module_competency_definition']),
-                'activity_names':               comp['activity_names'].replace("'", ""),
-                'question_ids':                 json.dumps(question_ids),
+                'competency_id':                comp_id,
+                'competency_type':              comp_type,
+                'module_compentency_area':      comp_area,
+                'module_competency_definition': definition_clean,
+                'activity_names':               activities_clean,
+                'question_ids':                 question_ids,
                 'question_count':               len(question_ids),
                 'course_id':                    course_id,
                 'competency_name':              module_name,
-                'module_domain':                module_fields['module_domain'],
+                'module_domain':                module_domain,
             }
         })
 
@@ -124,7 +179,7 @@ def process_module(module):
                 f"Correct Answer: {correct}\n"
                 f"Learning Objective: {obj}\n"
                 f"All Options: {opts}\n"
-                f"Competency: {comp['module_compentency_area']} ({comp['competency_type']})"
+                f"Competency: {comp_area} ({comp_type})"
             )
 
             mcqs.append({
@@ -137,12 +192,12 @@ def process_module(module):
                     'options_text':                      opts,
                     'correct_option_text':               correct,
                     'question_id_competency_definition': obj,
-                    'competency_id':                     comp['competency_id'],
-                    'competency_type':                   comp['competency_type'],
-                    'module_compentency_area':           comp['module_compentency_area'],
+                    'competency_id':                     comp_id,
+                    'competency_type':                   comp_type,
+                    'module_compentency_area':           comp_area,
                     'course_id':                         course_id,
                     'competency_name':                   module_name,
-                    'module_domain':                     module_fields['module_domain'],
+                    'module_domain':                     module_domain,
                 }
             })
 
@@ -150,7 +205,7 @@ def process_module(module):
     for checklist in module.get('question_type_checklist', []):
         question   = checklist['question']
         steps      = checklist['option']
-        steps_text = "\n".join(f"{s['option_sequence']}. {s['option_text']}" for s in steps)
+        steps_text = "\n".join([f"{s['option_sequence']}. {s['option_text']}" for s in steps])
 
         embed_text = truncate_if_needed(
             f"Procedural Checklist: {question['question_text']}\n"
@@ -167,29 +222,29 @@ def process_module(module):
                 'question_id':     str(question['question_id']),
                 'question_text':   question['question_text'],
                 'total_steps':     len(steps),
-                'steps':           json.dumps([
+                'steps':           [
                     {'step_number': s['option_sequence'], 'step_text': s['option_text']}
                     for s in steps
-                ]),
+                ],
                 'competency_type': 'Skill',
                 'course_id':       course_id,
                 'competency_name': module_name,
-                'module_domain':   module_fields['module_domain'],
+                'module_domain':   module_domain,
             }
         })
 
     return {
         'module_info':   module_fields,
+        'total_vectors': len(competencies) + len(mcqs) + len(checklists),
         'competencies':  competencies,
         'mcqs':          mcqs,
         'checklists':    checklists,
-        'total_vectors': len(competencies) + len(mcqs) + len(checklists),
     }
 
 
 # ── Main: loop over all JSON files ────────────────────────────────────────────
 
-def main():
+def main(pretty=False):
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
     json_files = sorted(INPUT_DIR.glob("*.json"))
@@ -198,24 +253,31 @@ def main():
         return
 
     logger.info(f"Found {len(json_files)} JSON file(s) to process")
-    grand_total = 0
+    grand_total, skipped = 0, 0
 
     for json_file in json_files:
         logger.info(f"\nProcessing file: {json_file.name}")
-        with open(json_file, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
+        src_hash = file_hash(json_file)
 
-        if not isinstance(raw_data, list):
-            raw_data = [raw_data]
-
-        for module in raw_data:
+        # Only one module is held in memory at a time
+        for module in iter_modules(json_file):
             try:
-                processed = process_module(module)
                 course_id = module['key_module_field']['course_id']
                 out_path  = OUTPUT_DIR / f"processed_module_{course_id}.json"
 
-                with open(out_path, 'w', encoding='utf-8') as f:
-                    json.dump(processed, f, indent=2, ensure_ascii=False)
+                # --pretty rewrites everything, otherwise unchanged modules would stay compact
+                cached_hash, cached_total = cached_summary(out_path)
+                if not pretty and cached_hash == src_hash:
+                    logger.info(f" {out_path.name} is up to date with {json_file.name} — skipped")
+                    grand_total += cached_total
+                    skipped += 1
+                    continue
+
+                processed = process_module(module)
+                processed['module_info']['source_hash'] = src_hash
+
+                # Compact by default — this is a machine-consumed intermediate
+                out_path.write_bytes(orjson.dumps(processed, option=orjson.OPT_INDENT_2 if pretty else None))
 
                 grand_total += processed['total_vectors']
                 logger.info(
@@ -231,9 +293,13 @@ def main():
 
     logger.info(f"\n{'='*60}")
     logger.info(f"All done! Grand total vectors across all modules: {grand_total}")
+    if skipped:
+        logger.info(f"Skipped {skipped} unchanged module(s)")
     logger.info(f"Output directory: {OUTPUT_DIR}")
     logger.info(f"{'='*60}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Preprocess raw module JSON files for embedding.")
+    parser.add_argument("--pretty", action="store_true", help="indent the processed JSON (rewrites every module, ignoring the source-hash cache)")
+    main(pretty=parser.parse_args().pretty)
\ No newline at end of file